@@ -4,11 +4,324 @@ Args: event - dict с httpMethod, body (query)
       context - object с request_id
 Returns: HTTP response с ответом (перевод, доклад, решение задачи)
 '''
+import hashlib
+import heapq
+import hmac
 import json
+import math
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, NamedTuple, Optional
+
+import psycopg2
 import requests
-from typing import Dict, Any
+
+# Допуск к внешним сервисам: ограниченное число слотов на каждый upstream
+# на все инстансы функции, PRO-пользователи обслуживаются первыми, бесплатные
+# запросы сбрасываются, если не успевают получить слот до своего дедлайна.
+
+# Слоты OpenAI по закону Литтла: столько вызовов одновременно выдерживает лимит
+# аккаунта (RPM, либо TPM при ~1000 токенов на запрос) при средней длительности вызова
+OPENAI_RPM = int(os.environ.get('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.environ.get('OPENAI_TPM', '200000'))
+OPENAI_TOKENS_PER_REQUEST = 1000
+OPENAI_AVG_CALL_SECONDS = 8
+OPENAI_DEFAULT_SLOTS = max(1, int(min(OPENAI_RPM, OPENAI_TPM / OPENAI_TOKENS_PER_REQUEST) * OPENAI_AVG_CALL_SECONDS / 60))
+
+UPSTREAM_SLOTS = {
+    'openai': int(os.environ.get('OPENAI_SLOTS', str(OPENAI_DEFAULT_SLOTS))),
+    # У Wikipedia API нет жёсткого лимита, но он просит не нагружать его параллельными запросами
+    'wikipedia': int(os.environ.get('WIKIPEDIA_SLOTS', '8')),
+}
+FREE_MAX_WAIT = float(os.environ.get('FREE_MAX_WAIT', '3'))
+PRO_MAX_WAIT = float(os.environ.get('PRO_MAX_WAIT', '20'))
+FREE_MAX_QUEUE = int(os.environ.get('FREE_MAX_QUEUE', '8'))
+PRO_MAX_QUEUE = int(os.environ.get('PRO_MAX_QUEUE', '8'))
+
+PRIORITY_PRO = 0
+PRIORITY_FREE = 1
+
+# Слот — строка admission_leases, её берут и отпускают короткими транзакциями,
+# поэтому на время вызова upstream соединение с БД не держится. Аренда истекает
+# сама, если инстанс упал, не отпустив её: срок больше самого долгого вызова.
+LEASE_SECONDS = {'openai': 60, 'wikipedia': 30}
+DEFAULT_SERVICE_MS = 5000.0
+
+# Соединение держит только ожидающий в очереди запрос, поэтому очереди
+# ограничивают число соединений допуска на все инстансы
+ADMISSION_CONNECTION_BUDGET = len(UPSTREAM_SLOTS) * (FREE_MAX_QUEUE + PRO_MAX_QUEUE)
+DB_CONNECT_TIMEOUT = 2
+
+ADVISORY_LOCK_CLASS = 7301
+UPSTREAM_LOCK_IDS = {'openai': 1, 'wikipedia': 2}
+POLL_INTERVAL = 0.25
+
+ACCESS_CACHE_TTL = 60
+ANSWER_CACHE_SIZE = 256
+
+# Формирование запросов к OpenAI: max_tokens по оценке нужной длины ответа
+MAX_INPUT_CHARS = int(os.environ.get('MAX_INPUT_CHARS', '4000'))
+TOKENS_PER_WORD = 2.5
+WORD_MARGIN = 1.2
+CHARS_PER_TOKEN = 3.0
+TRANSLATION_EXPANSION = 1.5
+# Пошаговое решение школьной задачи с ответом — около 250 слов
+MATH_BASE_TOKENS = 800
+OUTPUT_TOKEN_LIMITS = {
+    'translation': 1000,
+    'math': 2000,
+    'writing': 2000,
+    'general': 1000,
+}
+# Длиннее ответ не поместится в лимит токенов своего маршрута
+INPUT_CHAR_LIMITS = {
+    'translation': int((OUTPUT_TOKEN_LIMITS['translation'] - 50) / TRANSLATION_EXPANSION * CHARS_PER_TOKEN),
+    'math': int((OUTPUT_TOKEN_LIMITS['math'] - MATH_BASE_TOKENS) / 2 * CHARS_PER_TOKEN),
+    'writing': MAX_INPUT_CHARS,
+    'general': MAX_INPUT_CHARS,
+}
+DEFAULT_WRITING_WORDS = 500
+WORDS_PER_PARAGRAPH = 120
+MAX_WRITING_WORDS = int((OUTPUT_TOKEN_LIMITS['writing'] - 50) / (TOKENS_PER_WORD * WORD_MARGIN))
+MAX_WRITING_PARAGRAPHS = MAX_WRITING_WORDS // WORDS_PER_PARAGRAPH
+
+# Таймаут растёт с max_tokens по консервативной скорости генерации gpt-4o-mini
+OPENAI_TIMEOUT_BASE = 10
+OPENAI_TOKENS_PER_SECOND = 60
+OPENAI_MAX_TIMEOUT = 45
+
+
+class AdmissionTicket(NamedTuple):
+    upstream: str
+    route: str
+    lease_id: Optional[int]
+
+
+def estimate_queue_wait(slots: int, remaining_ms: list, ahead_ms: list) -> float:
+    '''Через сколько мс освободится слот после ожидающих впереди: remaining_ms — остаток
+    текущих вызовов, ahead_ms — ожидаемая длительность каждого запроса из очереди'''
+    free_at = list(remaining_ms) + [0.0] * max(0, slots - len(remaining_ms))
+    heapq.heapify(free_at)
+    for service_ms in ahead_ms:
+        heapq.heappush(free_at, heapq.heappop(free_at) + service_ms)
+    return free_at[0]
+
+
+class AdmissionController:
+    '''Слоты и приоритетная очередь на каждый upstream, общие для всех инстансов.
+    Слоты — аренды в admission_leases, очередь — admission_waiters, длительность
+    вызовов по маршрутам — admission_routes, счётчики — admission_metrics.
+    Без БД запросы допускаются без ограничений.'''
+
+    def __init__(self, slots: Dict[str, int]):
+        self.slots = dict(slots)
+
+    def _connect(self) -> Any:
+        return psycopg2.connect(os.environ['DATABASE_URL'], connect_timeout=DB_CONNECT_TIMEOUT)
+
+    def _lock(self, cursor: Any, upstream: str) -> None:
+        # Проверка свободных слотов и взятие аренды идут по одному upstream за раз
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (ADVISORY_LOCK_CLASS, UPSTREAM_LOCK_IDS[upstream]))
+
+    def _service_ms(self, cursor: Any, route: str) -> float:
+        cursor.execute("SELECT service_ms_avg FROM admission_routes WHERE route = %s", (route,))
+        row = cursor.fetchone()
+        return row[0] if row else DEFAULT_SERVICE_MS
+
+    def _count(self, cursor: Any, upstream: str, column: str) -> None:
+        cursor.execute(f"UPDATE admission_metrics SET {column} = {column} + 1 WHERE upstream = %s", (upstream,))
+
+    def _estimated_wait(self, cursor: Any, upstream: str, priority: int) -> float:
+        '''Оценка ожидания слота в секундах с учётом маршрутов текущих и ожидающих вызовов'''
+        cursor.execute(
+            "SELECT GREATEST(0, expected_ms - EXTRACT(EPOCH FROM (now() - started_at)) * 1000) FROM admission_leases WHERE upstream = %s AND expires_at > now()",
+            (upstream,)
+        )
+        remaining_ms = [float(row[0]) for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT r.service_ms_avg FROM admission_waiters w LEFT JOIN admission_routes r ON r.route = w.route "
+            "WHERE w.upstream = %s AND w.priority <= %s AND w.expires_at > now() ORDER BY w.priority, w.id",
+            (upstream, priority)
+        )
+        ahead_ms = [row[0] or DEFAULT_SERVICE_MS for row in cursor.fetchall()]
+        return estimate_queue_wait(self.slots[upstream], remaining_ms, ahead_ms) / 1000
+
+    def _try_lease(self, cursor: Any, upstream: str, route: str, priority: int, waiter_id: Optional[int]) -> Optional[int]:
+        '''Берёт аренду, если есть свободный слот и запрос не обгоняет очередь; вызывать под _lock'''
+        cursor.execute("SELECT count(*) FROM admission_leases WHERE upstream = %s AND expires_at > now()", (upstream,))
+        free_slots = self.slots[upstream] - cursor.fetchone()[0]
+        if free_slots <= 0:
+            return None
+        
+        if waiter_id is None:
+            cursor.execute(
+                "SELECT count(*) FROM admission_waiters WHERE upstream = %s AND priority <= %s AND expires_at > now()",
+                (upstream, priority)
+            )
+            if cursor.fetchone()[0] >= free_slots:
+                return None
+        else:
+            # Слот берут только первые free_slots ожидающих: PRO раньше бесплатных, внутри — по порядку
+            cursor.execute(
+                "SELECT id FROM admission_waiters WHERE upstream = %s AND expires_at > now() ORDER BY priority, id LIMIT %s",
+                (upstream, free_slots)
+            )
+            if waiter_id not in [row[0] for row in cursor.fetchall()]:
+                return None
+            cursor.execute("DELETE FROM admission_waiters WHERE id = %s", (waiter_id,))
+        
+        cursor.execute(
+            "INSERT INTO admission_leases (upstream, route, expected_ms, expires_at) VALUES (%s, %s, %s, now() + %s * interval '1 second') RETURNING id",
+            (upstream, route, self._service_ms(cursor, route), LEASE_SECONDS[upstream])
+        )
+        return cursor.fetchone()[0]
+
+    def _admitted(self, cursor: Any, upstream: str, started: float) -> None:
+        waited_ms = (time.monotonic() - started) * 1000
+        cursor.execute(
+            "UPDATE admission_metrics SET admitted = admitted + 1, wait_ms_total = wait_ms_total + %s, wait_ms_max = GREATEST(wait_ms_max, %s) WHERE upstream = %s",
+            (waited_ms, waited_ms, upstream)
+        )
+
+    def acquire(self, upstream: str, route: str, is_pro: bool) -> tuple:
+        '''Ждёт свободный слот; возвращает (ticket, retry_after), ticket None — запрос сброшен'''
+        unlimited = AdmissionTicket(upstream, route, None)
+        if not os.environ.get('DATABASE_URL'):
+            return (unlimited, 0)
+        
+        try:
+            conn = self._connect()
+        except Exception as e:
+            print(json.dumps({'event': 'admission_unavailable', 'error': str(e)}))
+            return (unlimited, 0)
+        
+        try:
+            return self._acquire(conn, upstream, route, is_pro)
+        except Exception as e:
+            # Сбой учёта не должен ронять ответ; взятая аренда истечёт сама
+            print(json.dumps({'event': 'admission_unavailable', 'error': str(e)}))
+            return (unlimited, 0)
+        finally:
+            conn.close()
+
+    def _acquire(self, conn: Any, upstream: str, route: str, is_pro: bool) -> tuple:
+        priority = PRIORITY_PRO if is_pro else PRIORITY_FREE
+        max_wait = PRO_MAX_WAIT if is_pro else FREE_MAX_WAIT
+        max_queue = PRO_MAX_QUEUE if is_pro else FREE_MAX_QUEUE
+        shed_column = 'shed_pro' if is_pro else 'shed_free'
+        started = time.monotonic()
+        deadline = started + max_wait
+        
+        with conn, conn.cursor() as cursor:
+            self._lock(cursor, upstream)
+            cursor.execute("DELETE FROM admission_leases WHERE expires_at < now()")
+            cursor.execute("DELETE FROM admission_waiters WHERE expires_at < now()")
+            
+            lease_id = self._try_lease(cursor, upstream, route, priority, None)
+            if lease_id:
+                self._admitted(cursor, upstream, started)
+                return (AdmissionTicket(upstream, route, lease_id), 0)
+            
+            estimate = self._estimated_wait(cursor, upstream, priority)
+            retry_after = max(1, math.ceil(estimate))
+            cursor.execute(
+                "SELECT count(*) FROM admission_waiters WHERE upstream = %s AND priority = %s",
+                (upstream, priority)
+            )
+            queued = cursor.fetchone()[0]
+            
+            # Очередь своего приоритета полна, или бесплатный запрос заведомо не дождётся слота
+            if queued >= max_queue or (not is_pro and estimate > max_wait):
+                self._count(cursor, upstream, shed_column)
+                return (None, retry_after)
+            
+            # Строки упавших инстансов перестают учитываться после expires_at
+            cursor.execute(
+                "INSERT INTO admission_waiters (upstream, route, priority, expires_at) VALUES (%s, %s, %s, now() + %s * interval '1 second') RETURNING id",
+                (upstream, route, priority, max_wait)
+            )
+            waiter_id = cursor.fetchone()[0]
+        
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with conn, conn.cursor() as cursor:
+                self._lock(cursor, upstream)
+                lease_id = self._try_lease(cursor, upstream, route, priority, waiter_id)
+                if lease_id:
+                    self._admitted(cursor, upstream, started)
+                    return (AdmissionTicket(upstream, route, lease_id), 0)
+                
+                if time.monotonic() >= deadline:
+                    cursor.execute("DELETE FROM admission_waiters WHERE id = %s", (waiter_id,))
+                    self._count(cursor, upstream, shed_column)
+                    return (None, max(1, math.ceil(estimate - max_wait)))
+
+    def release(self, ticket: AdmissionTicket, service_time: float) -> None:
+        if ticket.lease_id is None:
+            return
+        try:
+            conn = self._connect()
+            try:
+                with conn, conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM admission_leases WHERE id = %s", (ticket.lease_id,))
+                    # Скользящее среднее длительности по маршруту для оценки ожидания
+                    cursor.execute(
+                        "UPDATE admission_routes SET service_ms_avg = 0.8 * service_ms_avg + 0.2 * %s WHERE route = %s",
+                        (service_time * 1000, ticket.route)
+                    )
+            finally:
+                conn.close()
+        except Exception as e:
+            print(json.dumps({'event': 'admission_release_failed', 'error': str(e)}))
+
+    def snapshot(self) -> Dict[str, Any]:
+        conn = self._connect()
+        try:
+            with conn, conn.cursor() as cursor:
+                result = {'connectionBudget': ADMISSION_CONNECTION_BUDGET}
+                for upstream, slots in self.slots.items():
+                    cursor.execute(
+                        "SELECT count(*) FROM admission_leases WHERE upstream = %s AND expires_at > now()",
+                        (upstream,)
+                    )
+                    active = cursor.fetchone()[0]
+                    cursor.execute(
+                        "SELECT count(*), count(*) FILTER (WHERE priority = %s) FROM admission_waiters WHERE upstream = %s AND expires_at > now()",
+                        (PRIORITY_PRO, upstream)
+                    )
+                    queue_depth, queued_pro = cursor.fetchone()
+                    cursor.execute(
+                        "SELECT admitted, shed_free, shed_pro, wait_ms_total, wait_ms_max FROM admission_metrics WHERE upstream = %s",
+                        (upstream,)
+                    )
+                    admitted, shed_free, shed_pro, wait_ms_total, wait_ms_max = cursor.fetchone() or (0, 0, 0, 0.0, 0.0)
+                    result[upstream] = {
+                        'slots': slots,
+                        'active': active,
+                        'queueDepth': queue_depth,
+                        'queuedPro': queued_pro,
+                        'admitted': admitted,
+                        'shedFree': shed_free,
+                        'shedPro': shed_pro,
+                        'waitMsAvg': round(wait_ms_total / admitted, 1) if admitted else 0.0,
+                        'waitMsMax': round(wait_ms_max, 1),
+                    }
+                cursor.execute("SELECT route, service_ms_avg FROM admission_routes ORDER BY route")
+                result['serviceTimeMs'] = {route: round(service_ms, 1) for route, service_ms in cursor.fetchall()}
+                return result
+        finally:
+            conn.close()
+
+
+ADMISSION = AdmissionController(UPSTREAM_SLOTS)
+
+_access_cache: Dict[str, tuple] = {}
+_answer_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+_cache_lock = threading.Lock()
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
@@ -25,6 +338,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': ''
         }
     
+    if method == 'GET':
+        return metrics_response(event)
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -43,30 +359,128 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     # Определяем тип запроса и обрабатываем
+    route = classify_query(query)
+    
+    # Ответ без внешних сервисов не занимает слот
+    if route == 'translation':
+        simple_translation = translate_simple(query)
+        if simple_translation:
+            return answer_response(simple_translation, 'Встроенный словарь')
+    
+    # Без ключа OpenAI handle_* отвечают локально и тоже не занимают слот
+    if not uses_upstream(route):
+        answer, source = ROUTES[route](query)
+        return answer_response(answer, source)
+    
+    return answer_query(route, query, is_pro_user(body_data.get('token')))
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Метрики допуска для администратора (token в query string)"""
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if not os.environ.get('DATABASE_URL'):
+        return {
+            'statusCode': 503,
+            'headers': headers,
+            'body': json.dumps({'error': 'Database not configured'})
+        }
+    
+    params = event.get('queryStringParameters', {}) or {}
+    if not is_admin_user(params.get('token')):
+        return {
+            'statusCode': 403,
+            'headers': headers,
+            'body': json.dumps({'error': 'Admin token required'})
+        }
+    
+    try:
+        snapshot = ADMISSION.snapshot()
+    except Exception as e:
+        print(json.dumps({'event': 'admission_unavailable', 'error': str(e)}))
+        return {
+            'statusCode': 503,
+            'headers': headers,
+            'body': json.dumps({'error': 'Admission metrics unavailable'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'isBase64Encoded': False,
+        'body': json.dumps({'admission': snapshot})
+    }
+
+def uses_upstream(route: str) -> bool:
+    """Пойдёт ли запрос во внешний сервис"""
+    return route == 'wikipedia' or bool(os.environ.get('OPENAI_API_KEY'))
+
+def answer_query(route: str, query: str, is_pro: bool) -> Dict[str, Any]:
+    """Вызов внешнего сервиса через допуск; промах Wikipedia идёт в OpenAI через его слот"""
+    upstream = 'wikipedia' if route == 'wikipedia' else 'openai'
+    ticket, retry_after = ADMISSION.acquire(upstream, route, is_pro)
+    if not ticket:
+        return shed_response(route, query, retry_after)
+    
+    started = time.monotonic()
+    try:
+        answer, source = ROUTES[route](query)
+    finally:
+        ADMISSION.release(ticket, time.monotonic() - started)
+    
+    if route == 'wikipedia' and not source:
+        if not uses_upstream('general'):
+            answer, source = handle_general(query)
+            return answer_response(answer, source)
+        return answer_query('general', query, is_pro)
+    
+    if source:
+        remember_answer(query, answer, source)
+    
+    return answer_response(answer, source)
+
+def shed_response(route: str, query: str, retry_after: int) -> Dict[str, Any]:
+    """Сброшенный запрос: ответ без внешних сервисов или 429 с Retry-After"""
+    answer, source = handle_offline(route, query)
+    if answer:
+        return answer_response(answer, source)
+    return {
+        'statusCode': 429,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'Retry-After',
+            'Retry-After': str(retry_after)
+        },
+        'isBase64Encoded': False,
+        'body': json.dumps({
+            'error': 'Сервис перегружен, попробуйте позже',
+            'retryAfter': retry_after
+        })
+    }
+
+def classify_query(query: str) -> str:
+    """Определение типа запроса по ключевым словам"""
     query_lower = query.lower()
-    answer = ''
-    source = ''
     
     # 1. ПЕРЕВОД
     if any(word in query_lower for word in ['перевед', 'translate', 'translation']):
-        answer, source = handle_translation(query)
+        return 'translation'
     
     # 2. МАТЕМАТИКА
-    elif any(word in query_lower for word in ['реш', 'вычисли', 'посчитай', 'математик', '+', '-', '*', '/', '×', '÷', '=']):
-        answer, source = handle_math(query)
+    if any(word in query_lower for word in ['реш', 'вычисли', 'посчитай', 'математик', '+', '-', '*', '/', '×', '÷', '=']):
+        return 'math'
     
     # 3. НАУЧНЫЕ ВОПРОСЫ (Wikipedia)
-    elif any(word in query_lower for word in ['что такое', 'кто такой', 'расскажи о', 'что это', 'определение', 'теория', 'закон']):
-        answer, source = handle_wikipedia(query)
+    if any(word in query_lower for word in ['что такое', 'кто такой', 'расскажи о', 'что это', 'определение', 'теория', 'закон']):
+        return 'wikipedia'
     
     # 4. СОЧИНЕНИЯ, ДОКЛАДЫ, РЕФЕРАТЫ (OpenAI)
-    elif any(word in query_lower for word in ['сочинени', 'доклад', 'реферат', 'эссе', 'напиши', 'сделай', 'создай текст', 'абзац', 'слов']):
-        answer, source = handle_writing(query)
+    if any(word in query_lower for word in ['сочинени', 'доклад', 'реферат', 'эссе', 'напиши', 'сделай', 'создай текст', 'абзац', 'слов']):
+        return 'writing'
     
     # 5. ОСТАЛЬНОЕ (OpenAI или общий ответ)
-    else:
-        answer, source = handle_general(query)
-    
+    return 'general'
+
+def answer_response(answer: str, source: str) -> Dict[str, Any]:
     return {
         'statusCode': 200,
         'headers': {
@@ -80,6 +494,93 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         })
     }
 
+def verify_token(token: Any) -> Optional[str]:
+    """Проверка токена "<user_id>.<expires>.<hmac>", выданного функцией auth; возвращает user_id"""
+    secret = os.environ.get('AUTH_SECRET')
+    if not secret or not isinstance(token, str) or token.count('.') != 2:
+        return None
+    
+    user_id, expires, signature = token.split('.')
+    payload = f'{user_id}.{expires}'
+    expected = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        return None
+    if not user_id.isdigit() or not expires.isdigit() or int(expires) < time.time():
+        return None
+    return user_id
+
+def user_access(token: Any) -> Optional[tuple]:
+    """(has_pro, role) пользователя из подписанного токена, кэш на ACCESS_CACHE_TTL.
+    Промах кэша стоит отдельного подключения к БД до допуска к upstream."""
+    user_id = verify_token(token)
+    if not user_id:
+        return None
+    
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _access_cache.get(user_id)
+    if cached and now - cached[1] < ACCESS_CACHE_TTL:
+        return cached[0]
+    
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return None
+    
+    try:
+        conn = psycopg2.connect(database_url, connect_timeout=DB_CONNECT_TIMEOUT)
+    except Exception:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT has_pro, role FROM users WHERE id = %s", (int(user_id),))
+        row = cursor.fetchone()
+        cursor.close()
+    except Exception:
+        return None
+    finally:
+        conn.close()
+    
+    access = (bool(row[0]), row[1]) if row else None
+    with _cache_lock:
+        _access_cache[user_id] = (access, now)
+    return access
+
+def is_pro_user(token: Any) -> bool:
+    """PRO-статус по users.has_pro; без валидного токена запрос обслуживается как бесплатный"""
+    access = user_access(token)
+    return bool(access) and (access[0] or access[1] == 'admin')
+
+def is_admin_user(token: Any) -> bool:
+    access = user_access(token)
+    return bool(access) and access[1] == 'admin'
+
+def remember_answer(query: str, answer: str, source: str) -> None:
+    key = query.lower().strip()
+    with _cache_lock:
+        _answer_cache[key] = (answer, source)
+        _answer_cache.move_to_end(key)
+        while len(_answer_cache) > ANSWER_CACHE_SIZE:
+            _answer_cache.popitem(last=False)
+
+def handle_offline(route: str, query: str) -> tuple:
+    """Ответ без внешних сервисов для сброшенных запросов: кэш, словарь, калькулятор"""
+    with _cache_lock:
+        cached = _answer_cache.get(query.lower().strip())
+    if cached:
+        return (cached[0], f'{cached[1]} (из кэша)')
+    
+    if route == 'translation':
+        simple_translation = translate_simple(query)
+        if simple_translation:
+            return (simple_translation, 'Встроенный словарь')
+    
+    if route == 'math':
+        result = calculate_simple(query)
+        if result:
+            return (result, 'Встроенный калькулятор')
+    
+    return ('', '')
+
 def handle_translation(query: str) -> tuple:
     """Перевод через OpenAI ChatGPT или простой словарь"""
     
@@ -106,6 +607,11 @@ def handle_translation(query: str) -> tuple:
     
     # Извлекаем текст для перевода
     text_to_translate = re.sub(r'(перевед[иь]?|translate|на \w+|to \w+|:)', '', query, flags=re.IGNORECASE).strip()
+    notes = []
+    if len(text_to_translate) > INPUT_CHAR_LIMITS['translation']:
+        text_to_translate = trim_input(text_to_translate, INPUT_CHAR_LIMITS['translation'])
+        notes.append(f'Переведены только первые {len(text_to_translate)} символов текста.')
+    max_tokens = estimate_output_tokens('translation', text_to_translate)
     
     try:
         response = requests.post(
@@ -127,15 +633,16 @@ def handle_translation(query: str) -> tuple:
                     }
                 ],
                 'temperature': 0.3,
-                'max_tokens': 1000
+                'max_tokens': max_tokens
             },
-            timeout=30
+            timeout=openai_timeout(max_tokens)
         )
         
         if response.status_code == 200:
             data = response.json()
+            log_usage('translation', max_tokens, data)
             translation = data['choices'][0]['message']['content'].strip()
-            return (translation, 'ChatGPT Translation')
+            return (with_notes(translation, data, notes), 'ChatGPT Translation')
         else:
             return (f'Ошибка перевода: {response.status_code}', '')
             
@@ -148,15 +655,19 @@ def handle_math(query: str) -> tuple:
     
     if not api_key:
         # Простые вычисления без API
-        math_match = re.search(r'(\d+(?:\.\d+)?)\s*([+\-*/×÷])\s*(\d+(?:\.\d+)?)', query)
-        if math_match:
-            num1, op, num2 = float(math_match.group(1)), math_match.group(2), float(math_match.group(3))
-            ops = {'+': num1 + num2, '-': num1 - num2, '*': num1 * num2, '×': num1 * num2, 
-                   '/': num1 / num2 if num2 != 0 else 'деление на ноль', '÷': num1 / num2 if num2 != 0 else 'деление на ноль'}
-            result = ops.get(op, 'неизвестная операция')
-            return (f'Ответ: {result}', 'Встроенный калькулятор')
+        result = calculate_simple(query)
+        if result:
+            return (result, 'Встроенный калькулятор')
         return ('Укажите математическую задачу', '')
     
+    notes = []
+    problem = query
+    if len(problem) > INPUT_CHAR_LIMITS['math']:
+        problem = trim_input(problem, INPUT_CHAR_LIMITS['math'])
+        notes.append(f'Условие задачи сокращено до {len(problem)} символов.')
+    max_tokens = estimate_output_tokens('math', problem)
+    solution_words = int(max_tokens / (TOKENS_PER_WORD * WORD_MARGIN))
+    
     try:
         response = requests.post(
             'https://api.openai.com/v1/chat/completions',
@@ -169,23 +680,24 @@ def handle_math(query: str) -> tuple:
                 'messages': [
                     {
                         'role': 'system',
-                        'content': 'Ты математик-эксперт. Решай задачи пошагово и чётко. Показывай ход решения и финальный ответ.'
+                        'content': f'Ты математик-эксперт. Решай задачи пошагово и чётко. Показывай ход решения и финальный ответ. Уложись в {solution_words} слов, финальный ответ обязателен.'
                     },
                     {
                         'role': 'user',
-                        'content': query
+                        'content': problem
                     }
                 ],
                 'temperature': 0.2,
-                'max_tokens': 1500
+                'max_tokens': max_tokens
             },
-            timeout=30
+            timeout=openai_timeout(max_tokens)
         )
         
         if response.status_code == 200:
             data = response.json()
+            log_usage('math', max_tokens, data)
             solution = data['choices'][0]['message']['content'].strip()
-            return (solution, 'ChatGPT Math Solver')
+            return (with_notes(solution, data, notes), 'ChatGPT Math Solver')
         else:
             return (f'Ошибка решения: {response.status_code}', '')
             
@@ -242,11 +754,11 @@ def handle_wikipedia(query: str) -> tuple:
                             summary = extract[:800].strip()
                             return (f"{summary}...", f"Wikipedia: {page_title}")
         
-        # Если Wikipedia не нашла - используем OpenAI
-        return handle_general(query)
+        # Если Wikipedia не нашла - пустой ответ, handler спросит OpenAI
+        return ('', '')
         
     except Exception as e:
-        return handle_general(query)
+        return ('', '')
 
 def handle_writing(query: str) -> tuple:
     """Генерация текстов (сочинения, доклады, рефераты) через OpenAI"""
@@ -267,12 +779,31 @@ def handle_writing(query: str) -> tuple:
     if para_match:
         paragraph_count = int(para_match.group(1))
     
+    notes = []
+    if word_count and word_count > MAX_WRITING_WORDS:
+        print(json.dumps({'event': 'writing_over_budget', 'requestedWords': word_count, 'maxWords': MAX_WRITING_WORDS}))
+        notes.append(f'Запрошено {word_count} слов, за один ответ можно получить не больше {MAX_WRITING_WORDS}. Разбейте текст на части.')
+        word_count = MAX_WRITING_WORDS
+    if not word_count and paragraph_count and paragraph_count > MAX_WRITING_PARAGRAPHS:
+        print(json.dumps({'event': 'writing_over_budget', 'requestedParagraphs': paragraph_count, 'maxParagraphs': MAX_WRITING_PARAGRAPHS}))
+        notes.append(f'Запрошено {paragraph_count} абзацев, за один ответ можно получить не больше {MAX_WRITING_PARAGRAPHS}. Разбейте текст на части.')
+        paragraph_count = MAX_WRITING_PARAGRAPHS
+    
+    writing_request = query
+    if len(writing_request) > INPUT_CHAR_LIMITS['writing']:
+        writing_request = trim_input(writing_request, INPUT_CHAR_LIMITS['writing'])
+        notes.append(f'Задание сокращено до {len(writing_request)} символов.')
+    
     system_prompt = 'Ты профессиональный писатель и копирайтер. Создаёшь качественные тексты строго по требованиям.'
     
     if word_count:
         system_prompt += f' ВАЖНО: Текст должен быть РОВНО {word_count} слов. Не больше, не меньше.'
     if paragraph_count:
         system_prompt += f' ВАЖНО: Текст должен содержать РОВНО {paragraph_count} абзаца.'
+    if not word_count and not paragraph_count:
+        system_prompt += f' Объём текста — около {DEFAULT_WRITING_WORDS} слов, если не указано иное.'
+    
+    max_tokens = estimate_output_tokens('writing', query, word_count, paragraph_count)
     
     try:
         response = requests.post(
@@ -290,17 +821,18 @@ def handle_writing(query: str) -> tuple:
                     },
                     {
                         'role': 'user',
-                        'content': query
+                        'content': writing_request
                     }
                 ],
                 'temperature': 0.7,
-                'max_tokens': 2000
+                'max_tokens': max_tokens
             },
-            timeout=45
+            timeout=openai_timeout(max_tokens)
         )
         
         if response.status_code == 200:
             data = response.json()
+            log_usage('writing', max_tokens, data)
             text = data['choices'][0]['message']['content'].strip()
             
             # Проверяем соответствие требованиям
@@ -311,13 +843,76 @@ def handle_writing(query: str) -> tuple:
                 info += f", абзацев: {actual_paras}"
             info += ")"
             
-            return (text, info)
+            return (with_notes(text, data, notes), info)
         else:
             return (f'Ошибка генерации текста: {response.status_code}', '')
             
     except Exception as e:
         return (f'Не удалось создать текст: {str(e)}', '')
 
+def trim_input(text: str, max_chars: int) -> str:
+    """Обрезка слишком длинного пользовательского ввода по границе слова"""
+    if len(text) <= max_chars:
+        return text
+    trimmed = text[:max_chars]
+    cut = trimmed.rfind(' ')
+    if cut > max_chars // 2:
+        trimmed = trimmed[:cut]
+    return trimmed.rstrip()
+
+def estimate_output_tokens(route: str, text: str, word_count: Optional[int] = None, paragraph_count: Optional[int] = None) -> int:
+    """Оценка нужного числа токенов ответа по типу запроса и требованиям"""
+    if route == 'translation':
+        # Перевод примерно той же длины, что и исходный текст
+        estimate = len(text) / CHARS_PER_TOKEN * TRANSLATION_EXPANSION + 50
+    elif route == 'math':
+        estimate = MATH_BASE_TOKENS + len(text) / CHARS_PER_TOKEN * 2
+    elif route == 'writing':
+        if word_count:
+            words = word_count
+        elif paragraph_count:
+            words = paragraph_count * WORDS_PER_PARAGRAPH
+        else:
+            words = DEFAULT_WRITING_WORDS
+        estimate = words * TOKENS_PER_WORD * WORD_MARGIN + 50
+    else:
+        # Короткий вопрос — короткий ответ
+        estimate = 300 if len(text.split()) <= 15 else 600
+    return max(64, min(int(estimate), OUTPUT_TOKEN_LIMITS[route]))
+
+def openai_timeout(max_tokens: int) -> float:
+    """Таймаут запроса к OpenAI, достаточный для генерации max_tokens"""
+    return min(OPENAI_MAX_TIMEOUT, OPENAI_TIMEOUT_BASE + max_tokens / OPENAI_TOKENS_PER_SECOND)
+
+def with_notes(text: str, data: Dict[str, Any], notes: list) -> str:
+    """Предупреждения пользователю о сокращённом запросе или обрезанном по лимиту ответе"""
+    if data['choices'][0].get('finish_reason') == 'length':
+        notes = notes + ['Ответ обрезан: достигнут лимит длины. Сократите или разбейте запрос.']
+    return '\n\n'.join([text] + [f'⚠️ {note}' for note in notes])
+
+def log_usage(route: str, max_tokens: int, data: Dict[str, Any]) -> None:
+    """Лог оценки токенов против фактического usage из ответа OpenAI"""
+    usage = data.get('usage') or {}
+    print(json.dumps({
+        'event': 'openai_usage',
+        'route': route,
+        'maxTokens': max_tokens,
+        'promptTokens': usage.get('prompt_tokens'),
+        'completionTokens': usage.get('completion_tokens'),
+        'finishReason': data['choices'][0].get('finish_reason')
+    }))
+
+def calculate_simple(query: str) -> Optional[str]:
+    """Простые вычисления без API"""
+    math_match = re.search(r'(\d+(?:\.\d+)?)\s*([+\-*/×÷])\s*(\d+(?:\.\d+)?)', query)
+    if not math_match:
+        return None
+    num1, op, num2 = float(math_match.group(1)), math_match.group(2), float(math_match.group(3))
+    ops = {'+': num1 + num2, '-': num1 - num2, '*': num1 * num2, '×': num1 * num2, 
+           '/': num1 / num2 if num2 != 0 else 'деление на ноль', '÷': num1 / num2 if num2 != 0 else 'деление на ноль'}
+    result = ops.get(op, 'неизвестная операция')
+    return f'Ответ: {result}'
+
 def translate_simple(query: str) -> str:
     """Простой перевод без API для базовых слов"""
     query_lower = query.lower()
@@ -392,6 +987,14 @@ def handle_general(query: str) -> tuple:
     if not api_key:
         return ('Добро пожаловать в AI Platform! Я могу помочь с переводами (простые слова), математикой и поиском в Wikipedia. Для более сложных запросов требуется настройка OpenAI API.', '')
     
+    notes = []
+    question = query
+    if len(question) > INPUT_CHAR_LIMITS['general']:
+        question = trim_input(question, INPUT_CHAR_LIMITS['general'])
+        notes.append(f'Вопрос сокращён до {len(question)} символов.')
+    max_tokens = estimate_output_tokens('general', question)
+    answer_words = int(max_tokens / TOKENS_PER_WORD * 0.8)
+    
     try:
         response = requests.post(
             'https://api.openai.com/v1/chat/completions',
@@ -404,25 +1007,34 @@ def handle_general(query: str) -> tuple:
                 'messages': [
                     {
                         'role': 'system',
-                        'content': 'Ты умный AI-ассистент AI Platform. Отвечай кратко, понятно и по делу на русском языке.'
+                        'content': f'Ты умный AI-ассистент AI Platform. Отвечай кратко, понятно и по делу на русском языке. Уложись в {answer_words} слов.'
                     },
                     {
                         'role': 'user',
-                        'content': query
+                        'content': question
                     }
                 ],
                 'temperature': 0.7,
-                'max_tokens': 1000
+                'max_tokens': max_tokens
             },
-            timeout=30
+            timeout=openai_timeout(max_tokens)
         )
         
         if response.status_code == 200:
             data = response.json()
+            log_usage('general', max_tokens, data)
             answer = data['choices'][0]['message']['content'].strip()
-            return (answer, 'ChatGPT Assistant')
+            return (with_notes(answer, data, notes), 'ChatGPT Assistant')
         else:
             return ('Не удалось получить ответ. Попробуйте ещё раз.', '')
             
     except Exception as e:
-        return (f'Ошибка сервиса: {str(e)}', '')
\ No newline at end of file
+        return (f'Ошибка сервиса: {str(e)}', '')
+
+ROUTES = {
+    'translation': handle_translation,
+    'math': handle_math,
+    'wikipedia': handle_wikipedia,
+    'writing': handle_writing,
+    'general': handle_general,
+}
\ No newline at end of file
@@ -0,0 +1,306 @@
+'''
+Проверки допуска к upstream: порядок PRO/бесплатных, сброс по дедлайну, офлайн-ответы.
+Тесты с Postgres очищают таблицы допуска, поэтому идут только на отдельной
+тестовой БД из TEST_DATABASE_URL с применёнными миграциями db_migrations.
+Запуск: python -m unittest test_admission (из backend/ai-search)
+'''
+import json
+import os
+import threading
+import time
+import unittest
+from typing import Any, List
+from unittest import mock
+
+import psycopg2
+
+import index
+
+
+class FakeAdmission:
+    '''Контроллер без БД: допускает или сбрасывает всё и запоминает upstream'''
+
+    def __init__(self, admit: bool, retry_after: int = 7):
+        self.admit = admit
+        self.retry_after = retry_after
+        self.acquired: List[str] = []
+
+    def acquire(self, upstream: str, route: str, is_pro: bool) -> tuple:
+        self.acquired.append(upstream)
+        if self.admit:
+            return (index.AdmissionTicket(upstream, route, None), 0)
+        return (None, self.retry_after)
+
+    def release(self, ticket: Any, service_time: float) -> None:
+        pass
+
+
+def post(query: str) -> dict:
+    return index.handler({'httpMethod': 'POST', 'body': json.dumps({'query': query})}, None)
+
+
+class HandlerAdmissionTest(unittest.TestCase):
+    def setUp(self):
+        index._answer_cache.clear()
+        env = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test-key', 'DATABASE_URL': ''})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def use(self, admission: FakeAdmission) -> FakeAdmission:
+        patcher = mock.patch.object(index, 'ADMISSION', admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return admission
+
+    def test_shed_math_falls_back_to_calculator(self):
+        self.use(FakeAdmission(admit=False))
+        response = post('2 + 2')
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(json.loads(response['body'])['source'], 'Встроенный калькулятор')
+
+    def test_shed_uses_cached_answer(self):
+        self.use(FakeAdmission(admit=False))
+        index.remember_answer('Как дела?', 'Хорошо', 'ChatGPT Assistant')
+        body = json.loads(post('как дела?')['body'])
+        self.assertEqual(body['answer'], 'Хорошо')
+        self.assertIn('из кэша', body['source'])
+
+    def test_shed_without_offline_answer_returns_429(self):
+        self.use(FakeAdmission(admit=False, retry_after=7))
+        response = post('как дела?')
+        self.assertEqual(response['statusCode'], 429)
+        self.assertEqual(response['headers']['Retry-After'], '7')
+        self.assertIn('Retry-After', response['headers']['Access-Control-Expose-Headers'])
+        self.assertEqual(json.loads(response['body'])['retryAfter'], 7)
+
+    def test_local_answers_skip_admission(self):
+        admission = self.use(FakeAdmission(admit=False))
+        with mock.patch.dict(os.environ, {'OPENAI_API_KEY': ''}):
+            self.assertEqual(post('2 + 2')['statusCode'], 200)
+            self.assertEqual(post('как дела?')['statusCode'], 200)
+        self.assertEqual(post('переведи hello')['statusCode'], 200)
+        self.assertEqual(admission.acquired, [])
+
+    def test_wikipedia_miss_takes_openai_slot(self):
+        admission = self.use(FakeAdmission(admit=True))
+        routes = {
+            'wikipedia': lambda query: ('', ''),
+            'general': lambda query: ('Ответ', 'ChatGPT Assistant'),
+        }
+        with mock.patch.dict(index.ROUTES, routes):
+            body = json.loads(post('что такое квазар')['body'])
+        self.assertEqual(body['source'], 'ChatGPT Assistant')
+        self.assertEqual(admission.acquired, ['wikipedia', 'openai'])
+
+
+class MetricsEndpointTest(unittest.TestCase):
+    def get(self, token: str = None) -> dict:
+        params = {'token': token} if token else None
+        return index.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {'DATABASE_URL': 'postgresql://unused'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def test_requires_admin_token(self):
+        with mock.patch.object(index, 'user_access', return_value=(True, 'user')):
+            self.assertEqual(self.get('pro-token')['statusCode'], 403)
+        self.assertEqual(self.get()['statusCode'], 403)
+
+    def test_database_error_returns_503(self):
+        failing = mock.Mock()
+        failing.snapshot.side_effect = psycopg2.OperationalError('relation "admission_leases" does not exist')
+        with mock.patch.object(index, 'user_access', return_value=(True, 'admin')), mock.patch.object(index, 'ADMISSION', failing):
+            response = self.get('admin-token')
+        self.assertEqual(response['statusCode'], 503)
+        self.assertIn('error', json.loads(response['body']))
+
+    def test_admin_gets_snapshot(self):
+        admission = mock.Mock()
+        admission.snapshot.return_value = {'openai': {'active': 0}}
+        with mock.patch.object(index, 'user_access', return_value=(False, 'admin')), mock.patch.object(index, 'ADMISSION', admission):
+            response = self.get('admin-token')
+        self.assertEqual(json.loads(response['body']), {'admission': {'openai': {'active': 0}}})
+
+
+class QueueWaitEstimateTest(unittest.TestCase):
+    def test_free_slot_means_no_wait(self):
+        self.assertEqual(index.estimate_queue_wait(4, [40000, 40000], []), 0.0)
+
+    def test_wait_follows_the_soonest_call(self):
+        # Два эссе и перевод заняли слоты: ждать нужно только перевод
+        self.assertEqual(index.estimate_queue_wait(3, [40000, 40000, 1500], []), 1500)
+
+    def test_queue_ahead_is_served_in_order(self):
+        self.assertEqual(index.estimate_queue_wait(2, [1000, 3000], [2000, 2000]), 3000)
+
+
+@unittest.skipUnless(os.environ.get('TEST_DATABASE_URL'), 'TEST_DATABASE_URL is not set')
+class AdmissionControllerTest(unittest.TestCase):
+    def setUp(self):
+        database_url = os.environ['TEST_DATABASE_URL']
+        self.assertNotEqual(database_url, os.environ.get('DATABASE_URL'), 'TEST_DATABASE_URL must not be the production database')
+        env = mock.patch.dict(os.environ, {'DATABASE_URL': database_url})
+        env.start()
+        self.addCleanup(env.stop)
+
+        conn = psycopg2.connect(database_url)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM admission_waiters")
+        cursor.execute("DELETE FROM admission_leases")
+        cursor.execute("UPDATE admission_metrics SET admitted = 0, shed_free = 0, shed_pro = 0, wait_ms_total = 0, wait_ms_max = 0")
+        cursor.execute("UPDATE admission_routes SET service_ms_avg = 1000")
+        self.cursor = cursor
+        self.addCleanup(conn.close)
+
+    def controller(self) -> index.AdmissionController:
+        # Отдельный экземпляр на каждый «инстанс» функции: общего у них только БД
+        return index.AdmissionController({'openai': 1})
+
+    def hold_slot(self) -> index.AdmissionTicket:
+        ticket, _ = self.controller().acquire('openai', 'general', True)
+        self.assertIsNotNone(ticket.lease_id)
+        return ticket
+
+    def set_service_ms(self, value: float) -> None:
+        self.cursor.execute("UPDATE admission_routes SET service_ms_avg = %s", (value,))
+        self.cursor.execute("UPDATE admission_leases SET expected_ms = %s", (value,))
+
+    def waiting(self) -> int:
+        self.cursor.execute("SELECT count(*) FROM admission_waiters WHERE upstream = 'openai'")
+        return self.cursor.fetchone()[0]
+
+    def wait_for_waiters(self, count: int) -> None:
+        deadline = time.monotonic() + 5
+        while self.waiting() < count:
+            self.assertLess(time.monotonic(), deadline, 'waiter was not enqueued')
+            time.sleep(0.02)
+
+    def shed_count(self, column: str) -> int:
+        self.cursor.execute(f"SELECT {column} FROM admission_metrics WHERE upstream = 'openai'")
+        return self.cursor.fetchone()[0]
+
+    def connections(self) -> int:
+        # Бэкенд закрытого соединения завершается не мгновенно: ждём, пока число перестанет меняться
+        previous = -1
+        while True:
+            self.cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+            count = self.cursor.fetchone()[0]
+            if count == previous:
+                return count
+            previous = count
+            time.sleep(0.2)
+
+    def test_slot_is_shared_between_instances(self):
+        holder = self.hold_slot()
+        with mock.patch.object(index, 'FREE_MAX_WAIT', 0.5):
+            ticket, retry_after = self.controller().acquire('openai', 'general', False)
+        self.assertIsNone(ticket)
+        self.assertGreaterEqual(retry_after, 1)
+        self.controller().release(holder, 0.1)
+
+        ticket, _ = self.controller().acquire('openai', 'general', False)
+        self.assertIsNotNone(ticket)
+        self.controller().release(ticket, 0.1)
+
+    def test_lease_holds_no_connection(self):
+        before = self.connections()
+        holder = self.hold_slot()
+        self.assertEqual(self.connections(), before)
+        self.controller().release(holder, 0.1)
+
+    def test_expired_lease_frees_slot(self):
+        self.hold_slot()
+        self.cursor.execute("UPDATE admission_leases SET expires_at = now() - interval '1 second'")
+        ticket, _ = self.controller().acquire('openai', 'general', False)
+        self.assertIsNotNone(ticket.lease_id)
+
+    def test_pro_admitted_before_earlier_free(self):
+        holder = self.hold_slot()
+        order: List[str] = []
+
+        def request(name: str, is_pro: bool) -> None:
+            controller = self.controller()
+            ticket, _ = controller.acquire('openai', 'general', is_pro)
+            order.append(name if ticket else f'{name}:shed')
+            if ticket:
+                time.sleep(0.3)
+                controller.release(ticket, 0.3)
+
+        with mock.patch.object(index, 'FREE_MAX_WAIT', 5), mock.patch.object(index, 'PRO_MAX_WAIT', 5):
+            free = threading.Thread(target=request, args=('free', False))
+            free.start()
+            self.wait_for_waiters(1)
+            pro = threading.Thread(target=request, args=('pro', True))
+            pro.start()
+            self.wait_for_waiters(2)
+            self.controller().release(holder, 0.1)
+            free.join()
+            pro.join()
+
+        self.assertEqual(order, ['pro', 'free'])
+        self.assertEqual(self.waiting(), 0)
+
+    def test_free_shed_when_estimated_wait_exceeds_deadline(self):
+        self.hold_slot()
+        self.set_service_ms(10000)
+        started = time.monotonic()
+        with mock.patch.object(index, 'FREE_MAX_WAIT', 3):
+            ticket, retry_after = self.controller().acquire('openai', 'general', False)
+        self.assertIsNone(ticket)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(retry_after, 10)
+        self.assertEqual(self.shed_count('shed_free'), 1)
+        self.assertEqual(self.waiting(), 0)
+
+    def test_free_shed_at_deadline(self):
+        self.hold_slot()
+        self.set_service_ms(100)
+        started = time.monotonic()
+        with mock.patch.object(index, 'FREE_MAX_WAIT', 0.5):
+            ticket, _ = self.controller().acquire('openai', 'general', False)
+        self.assertIsNone(ticket)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(self.shed_count('shed_free'), 1)
+        self.assertEqual(self.waiting(), 0)
+
+    def test_pro_queue_is_capped(self):
+        self.hold_slot()
+        with mock.patch.object(index, 'PRO_MAX_QUEUE', 1), mock.patch.object(index, 'PRO_MAX_WAIT', 2):
+            first = threading.Thread(target=self.controller().acquire, args=('openai', 'general', True))
+            first.start()
+            self.wait_for_waiters(1)
+            ticket, _ = self.controller().acquire('openai', 'general', True)
+            self.assertIsNone(ticket)
+            self.assertEqual(self.shed_count('shed_pro'), 1)
+            first.join()
+
+    def test_pro_waits_past_free_estimate(self):
+        holder = self.hold_slot()
+        self.set_service_ms(10000)
+        threading.Timer(0.3, self.controller().release, args=(holder, 0.1)).start()
+        ticket, _ = self.controller().acquire('openai', 'general', True)
+        self.assertIsNotNone(ticket)
+        self.assertEqual(self.shed_count('shed_pro'), 0)
+        self.controller().release(ticket, 0.1)
+
+    def test_service_time_is_tracked_per_route(self):
+        ticket, _ = self.controller().acquire('openai', 'writing', False)
+        self.controller().release(ticket, 41)
+        snapshot = self.controller().snapshot()
+        self.assertEqual(snapshot['serviceTimeMs']['writing'], 0.8 * 1000 + 0.2 * 41000)
+        self.assertEqual(snapshot['serviceTimeMs']['translation'], 1000)
+
+    def test_snapshot_reports_shared_state(self):
+        holder = self.hold_slot()
+        snapshot = self.controller().snapshot()['openai']
+        self.assertEqual(snapshot['active'], 1)
+        self.assertEqual(snapshot['admitted'], 1)
+        self.controller().release(holder, 0.1)
+        self.assertEqual(self.controller().snapshot()['openai']['active'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
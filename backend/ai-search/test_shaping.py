@@ -0,0 +1,98 @@
+'''
+Проверки формирования запросов к OpenAI: лимиты ввода, max_tokens, таймауты, предупреждения.
+Запуск: python -m unittest test_shaping (из backend/ai-search)
+'''
+import os
+import unittest
+from unittest import mock
+
+import index
+
+
+def openai_reply(content: str, finish_reason: str = 'stop') -> mock.Mock:
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {
+        'choices': [{'message': {'content': content}, 'finish_reason': finish_reason}],
+        'usage': {'prompt_tokens': 10, 'completion_tokens': 20}
+    }
+    return response
+
+
+class ShapingTest(unittest.TestCase):
+    def setUp(self):
+        env = mock.patch.dict(os.environ, {'OPENAI_API_KEY': 'test-key'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def post(self, handle, query: str, reply: mock.Mock) -> tuple:
+        with mock.patch.object(index.requests, 'post', return_value=reply) as post:
+            answer, source = handle(query)
+        return answer, source, post.call_args.kwargs
+
+    def test_input_limits_fit_output_caps(self):
+        caps = dict(index.OUTPUT_TOKEN_LIMITS)
+        # Без ограничения сверху видно, сколько токенов на самом деле нужно самому длинному вводу
+        with mock.patch.dict(index.OUTPUT_TOKEN_LIMITS, {route: 10 ** 6 for route in caps}):
+            for route in ('translation', 'math'):
+                longest = 'я' * index.INPUT_CHAR_LIMITS[route]
+                self.assertLessEqual(index.estimate_output_tokens(route, longest), caps[route], route)
+
+    def test_timeouts_cover_every_cap(self):
+        for route, cap in index.OUTPUT_TOKEN_LIMITS.items():
+            self.assertGreaterEqual(
+                index.openai_timeout(cap) - index.OPENAI_TIMEOUT_BASE,
+                cap / index.OPENAI_TOKENS_PER_SECOND,
+                route
+            )
+
+    def test_long_translation_is_trimmed_and_reported(self):
+        answer, _, request = self.post(index.handle_translation, 'переведи: ' + 'слово ' * 1000, openai_reply('word'))
+        sent = request['json']['messages'][1]['content']
+        self.assertLessEqual(len(sent), index.INPUT_CHAR_LIMITS['translation'])
+        self.assertIn('Переведены только первые', answer)
+
+    def test_truncated_answer_is_reported(self):
+        answer, _, _ = self.post(index.handle_general, 'Расскажи про океаны', openai_reply('Океаны...', 'length'))
+        self.assertIn('Ответ обрезан', answer)
+
+    def test_short_question_gets_small_budget(self):
+        answer, _, request = self.post(index.handle_general, 'Сколько лет Земле?', openai_reply('4,5 млрд лет'))
+        self.assertEqual(answer, '4,5 млрд лет')
+        self.assertEqual(request['json']['max_tokens'], 300)
+        self.assertLess(request['timeout'], 30)
+
+    def test_writing_over_budget_is_capped_and_reported(self):
+        answer, source, request = self.post(index.handle_writing, 'Напиши сочинение на 3000 слов', openai_reply('Текст сочинения'))
+        self.assertEqual(request['json']['max_tokens'], index.OUTPUT_TOKEN_LIMITS['writing'])
+        self.assertIn(f'РОВНО {index.MAX_WRITING_WORDS} слов', request['json']['messages'][0]['content'])
+        self.assertIn('Запрошено 3000 слов', answer)
+        self.assertEqual(source, 'ChatGPT Writer (слов: 2)')
+
+
+    def test_default_essay_budget_fits_prompt(self):
+        _, _, request = self.post(index.handle_writing, 'Напиши сочинение про осень', openai_reply('Текст'))
+        self.assertIn(f'около {index.DEFAULT_WRITING_WORDS} слов', request['json']['messages'][0]['content'])
+        self.assertEqual(
+            request['json']['max_tokens'],
+            int(index.DEFAULT_WRITING_WORDS * index.TOKENS_PER_WORD * index.WORD_MARGIN + 50)
+        )
+
+    def test_paragraphs_over_budget_are_capped_and_reported(self):
+        answer, _, request = self.post(index.handle_writing, 'Напиши доклад, 12 абзацев', openai_reply('Текст'))
+        self.assertIn(f'РОВНО {index.MAX_WRITING_PARAGRAPHS} абзаца', request['json']['messages'][0]['content'])
+        self.assertLessEqual(request['json']['max_tokens'], index.OUTPUT_TOKEN_LIMITS['writing'])
+        self.assertIn('Запрошено 12 абзацев', answer)
+
+
+    def test_school_problem_gets_room_for_steps(self):
+        problem = 'Реши задачу: поезд проехал 240 км за 3 часа, а потом ещё 150 км за 2 часа. Найди среднюю скорость поезда.'
+        _, _, request = self.post(index.handle_math, problem, openai_reply('Ответ: 78 км/ч'))
+        max_tokens = request['json']['max_tokens']
+        words = int(max_tokens / (index.TOKENS_PER_WORD * index.WORD_MARGIN))
+        self.assertGreaterEqual(max_tokens, index.MATH_BASE_TOKENS)
+        self.assertGreaterEqual(words, 250)
+        self.assertIn(f'Уложись в {words} слов', request['json']['messages'][0]['content'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,46 @@ import json
 import os
 import psycopg2
 import hashlib
-from typing import Dict, Any
+import hmac
+import time
+from typing import Dict, Any, NamedTuple, Optional
+
+USER_COLUMNS = "id, email, role, has_pro, messages_used"
+TOKEN_TTL = 7 * 24 * 3600
+
+
+class UserRow(NamedTuple):
+    id: int
+    email: str
+    role: str
+    has_pro: bool
+    messages_used: int
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'email': self.email,
+            'role': self.role,
+            'hasPro': self.has_pro,
+            'messagesUsed': self.messages_used
+        }
+
+
+def fetch_user(cursor: Any) -> Optional[UserRow]:
+    '''Maps the next row selected with USER_COLUMNS to UserRow'''
+    row = cursor.fetchone()
+    return UserRow(*row) if row else None
+
+
+def issue_token(user_id: int) -> Optional[str]:
+    '''Signed session token "<user_id>.<expires>.<hmac>"; other functions verify it with AUTH_SECRET'''
+    secret = os.environ.get('AUTH_SECRET')
+    if not secret:
+        return None
+    payload = f"{user_id}.{int(time.time()) + TOKEN_TTL}"
+    signature = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}"
+
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -57,37 +96,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if action == 'register':
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         
-        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cursor.fetchone():
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Email already exists'})
-            }
-        
+        # One round trip: a concurrent sign-up with the same email makes the insert a no-op
         cursor.execute(
-            "INSERT INTO users (email, password_hash, role, has_pro, messages_used) VALUES (%s, %s, 'user', FALSE, 0) RETURNING id, email, role, has_pro, messages_used",
+            f"INSERT INTO users (email, password_hash, role, has_pro, messages_used) VALUES (%s, %s, 'user', FALSE, 0) ON CONFLICT (email) DO NOTHING RETURNING {USER_COLUMNS}",
             (email, password_hash)
         )
-        user_data = cursor.fetchone()
+        user = fetch_user(cursor)
         conn.commit()
         cursor.close()
         conn.close()
         
+        if not user:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Email already exists'})
+            }
+        
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'user': {
-                    'id': user_data[0],
-                    'email': user_data[1],
-                    'role': user_data[2],
-                    'hasPro': user_data[3],
-                    'messagesUsed': user_data[4]
-                }
+                'user': user.to_json(),
+                'token': issue_token(user.id)
             })
         }
     
@@ -98,14 +130,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             password_hash = hashlib.sha256(password.encode()).hexdigest()
         
         cursor.execute(
-            "SELECT id, email, role, has_pro, messages_used FROM users WHERE email = %s AND password_hash = %s",
+            f"SELECT {USER_COLUMNS} FROM users WHERE email = %s AND password_hash = %s",
             (email, password_hash)
         )
-        user_data = cursor.fetchone()
+        user = fetch_user(cursor)
         cursor.close()
         conn.close()
         
-        if not user_data:
+        if not user:
             return {
                 'statusCode': 401,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -117,13 +149,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'user': {
-                    'id': user_data[0],
-                    'email': user_data[1],
-                    'role': user_data[2],
-                    'hasPro': user_data[3],
-                    'messagesUsed': user_data[4]
-                }
+                'user': user.to_json(),
+                'token': issue_token(user.id)
             })
         }
     
@@ -0,0 +1,22 @@
+CREATE TABLE IF NOT EXISTS admission_waiters (
+    id SERIAL PRIMARY KEY,
+    upstream VARCHAR(32) NOT NULL,
+    priority SMALLINT NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_admission_waiters_queue ON admission_waiters(upstream, priority, id);
+
+CREATE TABLE IF NOT EXISTS admission_metrics (
+    upstream VARCHAR(32) PRIMARY KEY,
+    admitted BIGINT DEFAULT 0,
+    shed_free BIGINT DEFAULT 0,
+    shed_pro BIGINT DEFAULT 0,
+    wait_ms_total DOUBLE PRECISION DEFAULT 0,
+    wait_ms_max DOUBLE PRECISION DEFAULT 0,
+    service_ms_avg DOUBLE PRECISION DEFAULT 1000
+);
+
+INSERT INTO admission_metrics (upstream)
+VALUES ('openai'), ('wikipedia')
+ON CONFLICT (upstream) DO NOTHING;
@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS admission_leases (
+    id SERIAL PRIMARY KEY,
+    upstream VARCHAR(32) NOT NULL,
+    route VARCHAR(32) NOT NULL,
+    started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expected_ms DOUBLE PRECISION NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX idx_admission_leases_upstream ON admission_leases(upstream, expires_at);
+
+ALTER TABLE admission_waiters ADD COLUMN IF NOT EXISTS route VARCHAR(32) NOT NULL DEFAULT 'general';
+
+CREATE TABLE IF NOT EXISTS admission_routes (
+    route VARCHAR(32) PRIMARY KEY,
+    service_ms_avg DOUBLE PRECISION NOT NULL
+);
+
+INSERT INTO admission_routes (route, service_ms_avg)
+VALUES ('translation', 2000), ('math', 8000), ('writing', 25000), ('general', 5000), ('wikipedia', 1000)
+ON CONFLICT (route) DO NOTHING;
+
+ALTER TABLE admission_metrics DROP COLUMN IF EXISTS service_ms_avg;
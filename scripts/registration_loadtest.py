@@ -0,0 +1,134 @@
+'''
+Business: Load test for registration under concurrent duplicate-email storms
+Args: --emails distinct emails, --attempts concurrent sign-ups per email, --workers thread pool size,
+      --url auth function of a test environment (otherwise calls backend/auth handler directly);
+      DATABASE_URL of the same database is required to delete the created storm-* accounts
+Returns: exit code 0 if every email was registered exactly once and the rest got "Email already exists"
+Usage: DATABASE_URL=... python scripts/registration_loadtest.py --emails 20 --attempts 50 --workers 32
+'''
+import argparse
+import json
+import os
+import secrets
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'auth'))
+
+
+def register_direct(email: str, password: str) -> Tuple[int, Dict[str, Any]]:
+    from index import handler
+
+    response = handler({
+        'httpMethod': 'POST',
+        'body': json.dumps({'action': 'register', 'email': email, 'password': password})
+    }, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def register_http(url: str, email: str, password: str) -> Tuple[int, Dict[str, Any]]:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps({'action': 'register', 'email': email, 'password': password}).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def delete_accounts(run_id: str) -> int:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE email LIKE %s", (f'storm-{run_id}-%@example.com',))
+            return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def run(emails: int, attempts: int, workers: int, url: Optional[str]) -> bool:
+    run_id = uuid.uuid4().hex[:8]
+    jobs = [f'storm-{run_id}-{n}@example.com' for n in range(emails) for _ in range(attempts)]
+    try:
+        return storm(jobs, workers, url)
+    finally:
+        print(f'deleted {delete_accounts(run_id)} storm-{run_id}-* accounts', file=sys.stderr)
+
+
+def storm(jobs: list, workers: int, url: Optional[str]) -> bool:
+    def attempt(email: str) -> Tuple[str, int, str, float]:
+        # Random passwords keep the accounts unusable even if the cleanup fails
+        password = secrets.token_urlsafe(24)
+        started = time.perf_counter()
+        try:
+            if url:
+                status, body = register_http(url, email, password)
+            else:
+                status, body = register_direct(email, password)
+            error = body.get('error', '')
+        except Exception as e:
+            status, error = 0, str(e)
+        return email, status, error, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(attempt, jobs))
+    elapsed = time.perf_counter() - started
+
+    latencies = [r[3] * 1000 for r in results]
+    statuses = Counter(r[1] for r in results)
+    created = Counter(r[0] for r in results if r[1] == 200)
+    duplicates = sum(1 for r in results if r[1] == 400 and r[2] == 'Email already exists')
+    unexpected = [r for r in results if r[1] != 200 and not (r[1] == 400 and r[2] == 'Email already exists')]
+    wrong_emails = [email for email in set(jobs) if created[email] != 1]
+
+    print(json.dumps({
+        'requests': len(results),
+        'seconds': round(elapsed, 2),
+        'requestsPerSecond': round(len(results) / elapsed, 1),
+        'latencyMsP50': round(percentile(latencies, 0.5), 1),
+        'latencyMsP95': round(percentile(latencies, 0.95), 1),
+        'latencyMsMax': round(max(latencies), 1),
+        'statuses': {str(k): v for k, v in statuses.items()},
+        'created': sum(created.values()),
+        'duplicates': duplicates,
+        'unexpected': len(unexpected),
+        'emailsNotCreatedExactlyOnce': len(wrong_emails)
+    }, indent=2))
+
+    for email, status, error, _ in unexpected[:5]:
+        print(f'unexpected: {email} -> {status} {error}', file=sys.stderr)
+
+    return not unexpected and not wrong_emails
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent duplicate-email registration storm')
+    parser.add_argument('--emails', type=int, default=20)
+    parser.add_argument('--attempts', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--url', help='auth function URL of a test environment, see backend/func2url.json')
+    parser.add_argument('--test-environment', action='store_true', help='confirm that --url points to a test environment')
+    args = parser.parse_args()
+    if args.url and not args.test_environment:
+        parser.error('--url creates real accounts; pass --test-environment to confirm the target is not production')
+    if not os.environ.get('DATABASE_URL'):
+        parser.error('DATABASE_URL of the target database is required to delete the created accounts')
+    sys.exit(0 if run(args.emails, args.attempts, args.workers, args.url) else 1)
@@ -16,6 +16,7 @@ interface Message {
 interface ChatSectionProps {
   user: {
     id?: number;
+    token?: string;
     role: 'guest' | 'user' | 'admin';
     hasPro: boolean;
     messagesUsed: number;
@@ -148,13 +149,16 @@ const ChatSection = ({ user, canSendMessage, onSendMessage, messageLimit, onUpgr
       const response = await fetch(AI_SEARCH_URL, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ query: userQuery })
+        body: JSON.stringify({ query: userQuery, token: user.token })
       });
 
       const data = await response.json();
 
       let answerText = '';
-      if (data.answer) {
+      if (response.status === 429) {
+        const retryAfter = data.retryAfter ?? response.headers.get('Retry-After') ?? 5;
+        answerText = `Сервис сейчас перегружен. Попробуйте через ${retryAfter} сек. или оформите PRO для приоритетного доступа.`;
+      } else if (data.answer) {
         answerText = data.answer;
         if (data.source) {
           answerText += `\n\n📚 Источник: ${data.source}`;
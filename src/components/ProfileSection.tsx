@@ -11,6 +11,7 @@ import { toast } from 'sonner';
 interface User {
   id?: number;
   email?: string;
+  token?: string;
   role: 'guest' | 'user' | 'admin';
   hasPro: boolean;
   messagesUsed: number;
@@ -81,7 +82,8 @@ const ProfileSection = ({ user, setUser }: ProfileSectionProps) => {
           email: data.user.email,
           role: data.user.role,
           hasPro: data.user.hasPro,
-          messagesUsed: data.user.messagesUsed
+          messagesUsed: data.user.messagesUsed,
+          token: data.token
         });
         toast.success(authMode === 'login' ? 'Вход выполнен' : 'Регистрация завершена');
         setEmail('');
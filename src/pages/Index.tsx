@@ -9,6 +9,7 @@ type UserRole = 'guest' | 'user' | 'admin';
 interface User {
   id?: number;
   email?: string;
+  token?: string;
   role: UserRole;
   hasPro: boolean;
   messagesUsed: number;